@@ -10,4 +10,4 @@ for var in ["SESSION_SECRET", "PASSWORD_HASH", "GITHUB_TOKEN"]:
 from mangum import Mangum
 from sellout import app
 
-lambda_handler = Mangum(app)
+lambda_handler = Mangum(app, lifespan="off")
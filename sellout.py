@@ -1,20 +1,23 @@
 import os
 import re
+import asyncio
 import typing
 import functools
 import mimetypes
 import tomlkit
-from typing import Any, Tuple, List, Iterable, Mapping, TypedDict
+import orjson
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Optional, Tuple, List, Iterable, Mapping, TypedDict
 from datetime import datetime, timedelta, timezone
 from hashlib import sha1, sha256
 from base64 import urlsafe_b64decode, b64encode
 from secrets import token_urlsafe
+from time import monotonic
 from urllib.parse import urlencode
-from rfc3986 import uri_reference
+from rfc3986 import uri_reference, URIReference
 from dotenv import load_dotenv
 from argon2 import PasswordHasher, exceptions as argonerr
 from cryptography.hazmat.primitives import constant_time
-from multipart.multipart import parse_options_header
 from pydantic import BaseModel, ValidationError, conlist
 from slugify import slugify
 from starlette.applications import Starlette
@@ -31,21 +34,24 @@ from starlette.authentication import (
     has_required_scope,
 )
 from starlette.routing import Route, Mount
+from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException
 from starlette.templating import Jinja2Templates
 from starlette.staticfiles import StaticFiles
 from starlette.middleware import Middleware
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from starlette.middleware.authentication import AuthenticationMiddleware
-from starlette.datastructures import Headers, MutableHeaders, FormData, UploadFile
+from starlette.datastructures import Headers, FormData, UploadFile
 from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from aiodynamo.client import Client as DbClient
-from aiodynamo.credentials import Credentials as DbCreds
-from aiodynamo.errors import ItemNotFound
+from aiodynamo.credentials import Credentials as DbCreds, Key as DbKey
+from aiodynamo.errors import ItemNotFound, ConditionalCheckFailed
+from aiodynamo.expressions import F
 from aiodynamo.http.httpx import HTTPX
 from httpx_auth import AWS4Auth
 from gidgethub.httpx import GitHubAPI
-from httpx import AsyncClient
+from httpx import AsyncClient, Limits, Timeout
 
 SCOPE_INFO = {
     "profile": "Get basic profile information",
@@ -57,6 +63,9 @@ SCOPE_INFO = {
     "media": "Upload files using Micropub",
 }
 ALL_SCOPES = [k for k in SCOPE_INFO.keys()]
+COOKIE_CREDS = AuthCredentials(["auth", "via_cookie", *ALL_SCOPES])
+COOKIE_SCOPE_SET = frozenset(COOKIE_CREDS.scopes)
+ADMIN_USER = SimpleUser("admin")
 CSP_NOSCRIPT = "default-src 'self'; style-src 'self'; img-src 'self' data:; media-src 'none'; script-src 'none'; object-src 'none'; base-uri 'none'; frame-ancestors 'none'"
 COMMON_HEADERS = {
     "X-Frame-Options": "DENY",
@@ -67,7 +76,16 @@ COMMON_HEADERS = {
     "Permissions-Policy": "sync-xhr=(), accelerometer=(), camera=(), geolocation=(), gyroscope=(), magnetometer=(), microphone=(), payment=(), usb=()",
 }
 DEFAULT_HEADERS = {**COMMON_HEADERS, "Content-Security-Policy": CSP_NOSCRIPT}
+# Microformats property names use dashes, TOML keys under [extra] use underscores
+UNDERSCORE_TO_DASH = str.maketrans("_", "-")
+DASH_TO_UNDERSCORE = str.maketrans("-", "_")
 FRONTMATTER_RE = re.compile(r"^\+{3,}\s*$", re.MULTILINE)
+# revocation only evicts from the instance that handled it, others can see a revoked token for this long
+BEARER_CACHE_TTL = 60
+BEARER_MISS_CACHE_TTL = 10
+BEARER_CACHE_SIZE = 256
+BEARER_MISS_CACHE_SIZE = 64
+UPLOAD_CONCURRENCY = 8
 
 load_dotenv()
 aws_region = os.environ["AWS_REGION"]
@@ -82,6 +100,12 @@ github_owner, github_repo = os.environ["GITHUB_REPO"].split("/")
 github_branch = os.environ["GITHUB_BRANCH"]
 path_prefix = os.environ.get("PATH_PREFIX", "content/")
 hasher = PasswordHasher()
+# checked instead of the real hash when no password is submitted, so that takes as long as a wrong one
+# (a hash of random junk made once with the default PasswordHasher params, hashing at import would slow cold starts)
+DUMMY_PW_HASH = (
+    "$argon2id$v=19$m=102400,t=2,p=8$T/hZmTIy6Q14R29jo7TldQ$JqONnUR7BhyBX82q8hxDUQ"
+)
+db_creds = DbCreds.auto()
 tpl = Jinja2Templates(directory="tpl")
 
 mimetypes.add_type("font/woff2", ".woff2")
@@ -91,8 +115,73 @@ class DataError(Exception):
     pass
 
 
+def json_default(obj: Any) -> Any:
+    # orjson passes through str/int/dict/list subclasses, but not tomlkit's Float/DateTime/Date
+    if isinstance(obj, float):
+        return float(obj)
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    raise TypeError
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=json_default)
+
+
+def str_eq(a: Any, b: Any) -> bool:
+    return (
+        isinstance(a, str)
+        and isinstance(b, str)
+        and constant_time.bytes_eq(a.encode("utf-8"), b.encode("utf-8"))
+    )
+
+
+# rfc3986 is pure Python and clients send the same few URLs over and over
+@functools.lru_cache(maxsize=256)
+def parse_uri(url: str, normalize: bool = False) -> URIReference:
+    ref = uri_reference(url)
+    return ref.normalize() if normalize else ref
+
+
+def request_time(conn: HTTPConnection) -> datetime:
+    # one timezone-aware "now" per request, taken on first use
+    if "now" not in conn.scope:
+        conn.scope["now"] = datetime.now(timezone.utc)
+    return conn.scope["now"]
+
+
+http_client: Optional[AsyncClient] = None
+
+
+def get_http() -> AsyncClient:
+    # one pooled client for DynamoDB, S3 and GitHub, created on first use and kept for
+    # the life of the process (Mangum would run a lifespan around every single event)
+    # HTTP/2 is only used where the server negotiates it (GitHub), the rest stays on 1.1
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = AsyncClient(
+            http2=True,
+            limits=Limits(max_connections=200, max_keepalive_connections=50),
+            timeout=Timeout(10.0, connect=3.0),
+        )
+    return http_client
+
+
 def db_table(h, tbl):
-    return DbClient(HTTPX(h), DbCreds.auto(), aws_region).table(db_prefix + tbl)
+    return DbClient(HTTPX(h), db_creds, aws_region).table(db_prefix + tbl)
+
+
+# keys only change when the credentials get refreshed, no need to rebuild the signer for every upload
+@functools.lru_cache(maxsize=1)
+def s3_auth(key: DbKey) -> AWS4Auth:
+    return AWS4Auth(
+        access_id=key.id,
+        secret_key=key.secret,
+        security_token=key.token,
+        region=aws_region,
+        service="s3",
+    )
 
 
 # CloudFront -> API Gateway problems :/
@@ -102,16 +191,79 @@ class WeirdnessMiddleware(object):
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         if scope["type"] == "http":
-            headers = MutableHeaders(scope=scope)
-            xhost = headers.get("x-forwarded-host")
-            xauth = headers.get("x-authorization")
+            # one pass over the raw header list, rewritten in place
+            headers = scope["headers"]
+            xhost = xauth = None
+            host_idx = auth_idx = None
+            for idx, (name, value) in enumerate(headers):
+                if name == b"x-forwarded-host" and xhost is None:
+                    xhost = value
+                elif name == b"x-authorization" and xauth is None:
+                    xauth = value
+                elif name == b"host" and host_idx is None:
+                    host_idx = idx
+                elif name == b"authorization" and auth_idx is None:
+                    auth_idx = idx
             if xhost:
-                headers["host"] = xhost
+                if host_idx is None:
+                    headers.append((b"host", xhost))
+                else:
+                    headers[host_idx] = (b"host", xhost)
             if xauth:
-                headers["authorization"] = xauth
+                if auth_idx is None:
+                    headers.append((b"authorization", xauth))
+                else:
+                    headers[auth_idx] = (b"authorization", xauth)
         await self.app(scope, receive, send)
 
 
+def has_scopes(conn: HTTPConnection, scopes: typing.Sequence[str]) -> bool:
+    # set by our auth backend, fall back to the starlette check for anything that bypassed it
+    granted = conn.scope.get("scope_set")
+    if granted is None:
+        return has_required_scope(conn, scopes)
+    return granted.issuperset(scopes)
+
+
+# Static assets need neither the header fixups nor session/auth, skip straight to them
+class StaticMiddleware(object):
+    def __init__(self, app: ASGIApp, prefix: str, static_app: ASGIApp) -> None:
+        self.app = app
+        self.prefix = prefix.rstrip("/")
+        self.static_app = static_app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["path"].startswith(self.prefix + "/"):
+            # same scope rewrite the Mount would do
+            scope = {
+                **scope,
+                "root_path": scope.get("root_path", "") + self.prefix,
+                "path": scope["path"][len(self.prefix) :],
+            }
+            await self.static_app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+# Bearer-authed API calls never use the cookie session, don't make them decode it
+class ApiSessionMiddleware(object):
+    def __init__(self, app: ASGIApp, api_paths: typing.Sequence[str], **kwargs) -> None:
+        self.app = app
+        self.api_paths = tuple(api_paths)
+        self.session_app = SessionMiddleware(app, **kwargs)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (
+            scope["type"] == "http"
+            and scope["path"].startswith(self.api_paths)
+            and any(name == b"authorization" for name, _ in scope["headers"])
+        ):
+            scope["session"] = {}
+            await self.app(scope, receive, send)
+        else:
+            await self.session_app(scope, receive, send)
+
+
 # https://github.com/encode/starlette/pull/920
 def requires(
     scopes: typing.Union[str, typing.Sequence[str]],
@@ -125,9 +277,9 @@ def requires(
             request = kwargs.get("request", args[-1] if args else None)
             assert isinstance(request, Request)
 
-            if redirect is None and not has_required_scope(request, ["auth"]):
+            if redirect is None and not has_scopes(request, ["auth"]):
                 raise AuthenticationError(401, {"error": "unauthorized"})
-            if not has_required_scope(request, scopes_list):
+            if not has_scopes(request, scopes_list):
                 if redirect is not None:
                     next_url = "{redirect_path}?{orig_request}".format(
                         redirect_path=request.url_for(redirect),
@@ -147,20 +299,64 @@ TOK_ERR = AuthenticationError(
 )
 
 
+bearer_cache: "OrderedDict[str, Tuple[float, Mapping[str, Any]]]" = OrderedDict()
+# unknown tokens are kept apart, so a pile of made-up ones can't push out the real ones
+bearer_misses: "OrderedDict[str, float]" = OrderedDict()
+bearer_inflight: "Dict[str, asyncio.Future[Mapping[str, Any]]]" = {}
+
+
+def lru_put(cache: OrderedDict, key: str, value: Any, size: int) -> None:
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > size:
+        cache.popitem(last=False)
+
+
+async def fetch_bearer_data(h, key: str) -> Mapping[str, Any]:
+    try:
+        data = await db_table(h, "auth").get_item({"token": key})
+        expires = monotonic() + BEARER_CACHE_TTL
+        lru_put(bearer_cache, key, (expires, data), BEARER_CACHE_SIZE)
+        return data
+    except ItemNotFound:
+        # a client retrying with the same bad token doesn't need a GetItem every time
+        expires = monotonic() + BEARER_MISS_CACHE_TTL
+        lru_put(bearer_misses, key, expires, BEARER_MISS_CACHE_SIZE)
+        raise
+    finally:
+        bearer_inflight.pop(key, None)
+
+
+async def get_bearer_data(h, key: str) -> Mapping[str, Any]:
+    now = monotonic()
+    hit = bearer_cache.get(key)
+    if hit is not None and hit[0] > now:
+        bearer_cache.move_to_end(key)
+        return hit[1]
+    miss = bearer_misses.get(key)
+    if miss is not None and miss > now:
+        raise ItemNotFound()
+    # concurrent misses for the same token all wait on a single GetItem
+    fut = bearer_inflight.get(key)
+    if fut is None:
+        fut = bearer_inflight[key] = asyncio.ensure_future(fetch_bearer_data(h, key))
+    # shielded so that one waiter getting cancelled doesn't cancel the lookup for the others
+    return await asyncio.shield(fut)
+
+
 async def authenticate_bearer(
     conn: HTTPConnection, token: str
 ) -> Tuple[AuthCredentials, BaseUser]:
-    async with AsyncClient() as h:
-        try:
-            data = await db_table(h, "auth").get_item({"token": "B-" + token})
-            if data.get("revoked") or data["host"] != conn.headers["host"]:
-                raise TOK_ERR
-            conn.scope["bearer_data"] = data
-            return AuthCredentials(["auth", "via_bearer", *data["scopes"]]), SimpleUser(
-                "admin"
-            )
-        except ItemNotFound:
+    try:
+        data = await get_bearer_data(get_http(), "B-" + token)
+        if data.get("revoked") or not str_eq(data["host"], conn.headers["host"]):
             raise TOK_ERR
+        conn.scope["bearer_data"] = data
+        creds = AuthCredentials(["auth", "via_bearer", *data["scopes"]])
+        conn.scope["scope_set"] = frozenset(creds.scopes)
+        return creds, ADMIN_USER
+    except ItemNotFound:
+        raise TOK_ERR
 
 
 class TokenAndSessionBackend(AuthenticationBackend):
@@ -168,9 +364,8 @@ class TokenAndSessionBackend(AuthenticationBackend):
         self, conn: HTTPConnection
     ) -> Tuple[AuthCredentials, BaseUser]:
         if conn.session.get("au", False):
-            return AuthCredentials(["auth", "via_cookie", *ALL_SCOPES]), SimpleUser(
-                "admin"
-            )
+            conn.scope["scope_set"] = COOKIE_SCOPE_SET
+            return COOKIE_CREDS, ADMIN_USER
         if "Authorization" in conn.headers:
             try:
                 scheme, token = conn.headers["Authorization"].split()
@@ -212,8 +407,12 @@ class Login(HTTPEndpoint):
         if request.user.is_authenticated:
             return RedirectResponse(url=next, status_code=303)
         error = "Something error??"
+        pw = form.get("pw", "")
         try:
-            if hasher.verify(admin_pw_hash, form.get("pw", "")):
+            # argon2 takes a while and releases the GIL, don't block the event loop on it
+            if await run_in_threadpool(
+                hasher.verify, admin_pw_hash if pw else DUMMY_PW_HASH, pw
+            ):
                 request.session["au"] = True
                 return RedirectResponse(url=next, status_code=303)
         except argonerr.VerifyMismatchError as err:
@@ -234,38 +433,55 @@ def profile(request: Request) -> Mapping[str, Any]:
     return {"me": "https://{}/".format(request.headers["host"])}
 
 
-async def redeem_auth_code(request: Request, form: FormData) -> Mapping[str, Any]:
+async def check_auth_code(request: Request, form: FormData) -> Mapping[str, Any]:
     if form.get("grant_type") != "authorization_code":
         raise AuthenticationError(400, {"error": "unsupported_grant_type"})
     if not "code" in form or not "client_id" in form or not "redirect_uri" in form:
         raise AuthenticationError(400, {"error": "invalid_request"})
-    async with AsyncClient() as h:
-        try:
-            tbl = db_table(h, "auth")
-            data = await tbl.get_item({"token": "C-" + form["code"]})
-            time = datetime.fromisoformat(data["time"])
-            if (
-                datetime.utcnow() - time > timedelta(minutes=5)
-                or form["client_id"] != data["client_id"]
-                or form["redirect_uri"] != data["redirect_uri"]
-                or data.get("used", False)
-                or data["host"] != request.headers["host"]
+    try:
+        tbl = db_table(get_http(), "auth")
+        data = await tbl.get_item({"token": "C-" + form["code"]})
+        time = datetime.fromisoformat(data["time"])
+        if time.tzinfo is None:  # written before we switched to aware timestamps
+            time = time.replace(tzinfo=timezone.utc)
+        if (
+            request_time(request) - time > timedelta(minutes=5)
+            or not str_eq(form["client_id"], data["client_id"])
+            or not str_eq(form["redirect_uri"], data["redirect_uri"])
+            or data.get("used", False)
+            or not str_eq(data["host"], request.headers["host"])
+        ):
+            raise AuthenticationError(400, {"error": "invalid_grant"})
+        if data.get("code_challenge_method") == "S256":
+            if not "code_verifier" in form:
+                raise AuthenticationError(400, {"error": "invalid_request"})
+            if not constant_time.bytes_eq(
+                sha256(form["code_verifier"].encode("ascii")).digest(),
+                urlsafe_b64decode(data["code_challenge"] + "=="),
             ):
+                # ^^ fun fact, we can always just add the padding: https://stackoverflow.com/a/49459036
                 raise AuthenticationError(400, {"error": "invalid_grant"})
-            if data.get("code_challenge_method") == "S256":
-                if not "code_verifier" in form:
-                    raise AuthenticationError(400, {"error": "invalid_request"})
-                if not constant_time.bytes_eq(
-                    sha256(form["code_verifier"].encode("ascii")).digest(),
-                    urlsafe_b64decode(data["code_challenge"] + "=="),
-                ):
-                    # ^^ fun fact, we can always just add the padding: https://stackoverflow.com/a/49459036
-                    raise AuthenticationError(400, {"error": "invalid_grant"})
-            data["used"] = True
-            await tbl.put_item(data)
-            return data
-        except (ItemNotFound, KeyError):
-            raise AuthenticationError(400, {"error": "invalid_grant"})
+        return data
+    except (ItemNotFound, KeyError):
+        raise AuthenticationError(400, {"error": "invalid_grant"})
+
+
+async def claim_auth_code(request: Request, data: Mapping[str, Any]) -> None:
+    # conditional, so two concurrent redemptions of the same code can't both succeed
+    try:
+        await db_table(get_http(), "auth").update_item(
+            {"token": data["token"]},
+            F("used").set(True),
+            condition=F("used").does_not_exist() | F("used").equals(False),
+        )
+    except ConditionalCheckFailed:
+        raise AuthenticationError(400, {"error": "invalid_grant"})
+
+
+async def redeem_auth_code(request: Request, form: FormData) -> Mapping[str, Any]:
+    data = await check_auth_code(request, form)
+    await claim_auth_code(request, data)
+    return data
 
 
 def autherr(request: Request, err) -> Response:
@@ -291,12 +507,13 @@ class Authorization(HTTPEndpoint):
             return autherr(request, "redirect_uri MUST exist")
         if not "state" in request.query_params:
             return autherr(request, "state MUST exist")
-        client_id = uri_reference(request.query_params.get("client_id")).normalize()
+        client_id = parse_uri(request.query_params["client_id"], normalize=True)
+        # normalize() lowercases the scheme, so HTTPS://... is fine too
+        if client_id.scheme not in ("https", "http"):
+            return autherr(request, "client_id MUST be an http(s) URL")
         if not client_id.is_valid(require_scheme=True, require_authority=True):
             return autherr(request, "client_id MUST be a valid URL")
-        redirect_uri = uri_reference(
-            request.query_params.get("redirect_uri")
-        ).normalize()
+        redirect_uri = parse_uri(request.query_params["redirect_uri"], normalize=True)
         if not redirect_uri.is_valid(require_scheme=True, require_authority=True):
             return autherr(request, "redirect_uri MUST be a valid URL")
         if (
@@ -322,7 +539,7 @@ class Authorization(HTTPEndpoint):
     async def post(self, request: Request) -> Response:
         form = await request.form()
         await redeem_auth_code(request, form)
-        return JSONResponse(profile(request))
+        return ORJSONResponse(profile(request))
 
 
 class Token(HTTPEndpoint):
@@ -332,41 +549,54 @@ class Token(HTTPEndpoint):
         bd = request.scope["bearer_data"]
         resp["client_id"] = bd["client_id"]
         resp["scope"] = " ".join(bd["scopes"])
-        return JSONResponse(resp)
+        return ORJSONResponse(resp)
 
     async def post(self, request: Request) -> Response:
         form = await request.form()
+        host = request.headers["host"]
         if form.get("action") == "revoke":
-            async with AsyncClient() as h:
-                try:
-                    tbl = db_table(h, "auth")
-                    data = await tbl.get_item({"token": "B-" + form["token"]})
-                    if data["host"] == request.headers["host"]:
-                        data["revoked"] = True
-                        await tbl.put_item(data)
-                except Exception as e:
-                    # for requests from the admin UI, do not follow the OAuth spec and return the error
-                    if has_required_scope(request, ["via_cookie"]):
-                        # XXX: says "indieauth client"
-                        return autherr(request, str(e))
-            return JSONResponse({})
-        code_data = await redeem_auth_code(request, form)
+            try:
+                tbl = db_table(get_http(), "auth")
+                data = await tbl.get_item({"token": "B-" + form["token"]})
+                if data["host"] == host:
+                    data["revoked"] = True
+                    await tbl.put_item(data)
+                    bearer_cache.pop(data["token"], None)
+            except Exception as e:
+                # for requests from the admin UI, do not follow the OAuth spec and return the error
+                if has_required_scope(request, ["via_cookie"]):
+                    # XXX: says "indieauth client"
+                    return autherr(request, str(e))
+            return ORJSONResponse({})
+        code_data = await check_auth_code(request, form)
         bearer = token_urlsafe(16)
         data = {
             "token": "B-" + bearer,
-            "time": datetime.utcnow().isoformat(),
+            "time": request_time(request).isoformat(),
             "code_used": code_data["token"],
             "client_id": code_data["client_id"],
             "scopes": code_data["scopes"],
-            "host": request.headers["host"],
+            "host": host,
         }
-        async with AsyncClient() as h:
-            await db_table(h, "auth").put_item(data)
+        # write the token while claiming the code, it's only handed out if the claim succeeded
+        tbl = db_table(get_http(), "auth")
+        claim_err, put_err = await asyncio.gather(
+            claim_auth_code(request, code_data),
+            tbl.put_item(data),
+            return_exceptions=True,
+        )
+        if claim_err is not None:
+            # lost the race for the code, don't leave a token row behind that nobody got
+            if put_err is None:
+                await tbl.delete_item({"token": data["token"]})
+            raise claim_err
+        if put_err is not None:
+            raise put_err
         resp = profile(request)
         resp["token_type"] = "Bearer"
         resp["access_token"] = bearer
         resp["scope"] = " ".join(data["scopes"])
-        return JSONResponse(resp)
+        return ORJSONResponse(resp)
 
 
 @requires("via_cookie", redirect="login")
@@ -384,7 +614,7 @@ async def allow(request: Request) -> Response:
     code = token_urlsafe(16)
     data = {
         "token": "C-" + code,
-        "time": datetime.utcnow().isoformat(),
+        "time": request_time(request).isoformat(),
         "client_id": form["client_id"],
         "redirect_uri": form["redirect_uri"],
         "state": form["state"],
@@ -393,14 +623,13 @@ async def allow(request: Request) -> Response:
         "scopes": scopes,
         "host": request.headers["host"],
     }
-    redir_uri = uri_reference(form["redirect_uri"]).normalize()
+    redir_uri = parse_uri(form["redirect_uri"], normalize=True)
     redir_dest = redir_uri.copy_with(
         query=(redir_uri.query or "")
         + ("" if not redir_uri.query else "&")
         + urlencode({"code": code, "state": form["state"]})
     ).unsplit()
-    async with AsyncClient() as h:
-        await db_table(h, "auth").put_item(data)
+    await db_table(get_http(), "auth").put_item(data)
     return RedirectResponse(url=redir_dest, status_code=303)
 
 
@@ -433,6 +662,17 @@ async def testpage(request: Request) -> Response:
 Post = Tuple[tomlkit.toml_document.TOMLDocument, str]
 
 
+def split_frontmatter(raw_text: str) -> Tuple[str, str]:
+    # fast path for the usual "+++\n<toml>\n+++\n<content>", same result as the regex split
+    if raw_text.startswith("+++\n") and not raw_text[4:5].isspace():
+        end = raw_text.find("\n+++", 3) + 1
+        m = end and FRONTMATTER_RE.match(raw_text, end)
+        if m:
+            return raw_text[3:end], raw_text[m.end() :]
+    _, fm_text, content_text = FRONTMATTER_RE.split(raw_text, 2)
+    return fm_text, content_text
+
+
 async def get_post(h, path: str) -> Tuple[Post, str]:
     raw_text = await GitHubAPI(h, "sellout", oauth_token=github_token).getitem(
         "/repos/{owner}/{repo}/contents/{path}{?ref}",
@@ -444,31 +684,46 @@ async def get_post(h, path: str) -> Tuple[Post, str]:
         },
         accept="application/vnd.github.v3.raw",
     )
-    _, fm_text, content_text = FRONTMATTER_RE.split(raw_text, 2)
+    fm_text, content_text = split_frontmatter(raw_text)
     utf8_text = raw_text.encode("utf-8")
-    post_sha = sha1(
-        "blob {}\0".format(len(utf8_text)).encode("utf-8") + utf8_text
-    ).hexdigest()
+    blob_hash = sha1(b"blob %d\0" % len(utf8_text))
+    blob_hash.update(utf8_text)
+    post_sha = blob_hash.hexdigest()
     return ((tomlkit.loads(fm_text), content_text), post_sha)
 
 
+async def get_post_sha(h, path: str) -> str:
+    # the metadata response has the blob sha already, no need to parse or hash anything
+    meta = await GitHubAPI(h, "sellout", oauth_token=github_token).getitem(
+        "/repos/{owner}/{repo}/contents/{path}{?ref}",
+        url_vars={
+            "owner": github_owner,
+            "repo": github_repo,
+            "path": path,
+            "ref": github_branch,
+        },
+        accept="application/vnd.github.v3+json",
+    )
+    return meta["sha"]
+
+
 async def put_post(h, path: str, post: Post, post_sha: str = None):
     (fm, content_text) = post
-    raw_text = "+++"
     fm_text = tomlkit.dumps(fm)
+    parts = [b"+++"]
     if not fm_text.startswith("\n"):
-        raw_text += "\n"
-    raw_text += fm_text
-    if not raw_text.endswith("\n"):
-        raw_text += "\n"
-    raw_text += "+++\n"
+        parts.append(b"\n")
+    parts.append(fm_text.encode("utf-8"))
+    if fm_text and not fm_text.endswith("\n"):
+        parts.append(b"\n")
+    parts.append(b"+++\n")
     if not content_text.startswith("\n"):
-        raw_text += "\n"
-    raw_text += content_text
+        parts.append(b"\n")
+    parts.append(content_text.encode("utf-8"))
     data = {
         "branch": github_branch,
         "message": "[micropub] put " + path,
-        "content": b64encode(raw_text.encode("utf-8")).decode("ascii"),
+        "content": b64encode(b"".join(parts)).decode("ascii"),
     }
     if post_sha:
         data["sha"] = post_sha
@@ -500,10 +755,9 @@ async def delete_post(h, path: str, post_sha: str):
 
 
 def url2path(request: Request, url: str) -> str:
-    parts = uri_reference(url)
-    if parts.authority != request.headers["host"] and not request.headers[
-        "host"
-    ].startswith("127.0.0.1"):
+    parts = parse_uri(url)
+    host = request.headers["host"]
+    if parts.authority != host and not host.startswith("127.0.0.1"):
         raise DataError(
             400,
             {
@@ -514,45 +768,51 @@ def url2path(request: Request, url: str) -> str:
     return os.path.join(path_prefix, parts.path.lstrip("/") + ".md")
 
 
-async def upload_file(file: UploadFile) -> str:
+async def upload_file(h, file: UploadFile) -> str:
     # can't stream on Lambda anyway heh
+    # (and AWS4Auth calls request.read() to hash the payload, so the body has to be bytes)
     cont = await file.read()
     assert isinstance(cont, bytes)
+    # we have our own copy now, no need to keep the spooled one during the PUT
+    await file.close()
     base, ext = os.path.splitext(file.filename)
     name = sha256(cont).hexdigest()[:6] + "_" + slugify(base) + ext
-    async with AsyncClient() as h:
-        key = await DbCreds.auto().get_key(HTTPX(h))
-        assert key != None
-        auth = AWS4Auth(
-            access_id=key.id,
-            secret_key=key.secret,
-            security_token=key.token,
-            region=aws_region,
-            service="s3",
-        )
-        resp = await h.put(
-            "https://{}.s3.amazonaws.com/{}{}".format(media_bucket, media_prefix, name),
-            auth=auth,
-            headers={
-                "Content-Type": file.content_type,
-                "Content-Length": str(len(cont)),
-                "Content-Disposition": "inline",
-                "Cache-Control": "public, max-age=31536000, immutable",
+    key = await db_creds.get_key(HTTPX(h))
+    assert key != None
+    resp = await h.put(
+        "https://{}.s3.amazonaws.com/{}{}".format(media_bucket, media_prefix, name),
+        auth=s3_auth(key),
+        headers={
+            "Content-Type": file.content_type,
+            "Content-Length": str(len(cont)),
+            "Content-Disposition": "inline",
+            "Cache-Control": "public, max-age=31536000, immutable",
+        },
+        content=cont,
+    )
+    print(resp.content)
+    if resp.status_code > 300:
+        raise DataError(
+            500,
+            {
+                "error": "server_error",
+                "error_description": "S3 error {}".format(resp.status_code),
             },
-            content=cont,
         )
-        print(resp.content)
-        if resp.status_code > 300:
-            raise DataError(
-                500,
-                {
-                    "error": "server_error",
-                    "error_description": "S3 error {}".format(resp.status_code),
-                },
-            )
     return media_url + name
 
 
+async def upload_files(h, files: List[UploadFile]) -> List[str]:
+    # upload concurrently (but not too many at once), results are in the same order
+    slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def upload(file: UploadFile) -> str:
+        async with slots:
+            return await upload_file(h, file)
+
+    return await asyncio.gather(*(upload(f) for f in files))
+
+
 MfProps = Mapping[str, List[Any]]
 
 
@@ -561,23 +821,27 @@ class MfObj(BaseModel):
     properties: MfProps
 
 
+def as_datetime(val: Any) -> datetime:
+    # json2post_inner always stores native TOML datetimes (tomlkit.items.DateTime is a datetime),
+    # only hand-written posts can have them as strings
+    if isinstance(val, datetime):
+        return val
+    return datetime.fromisoformat(val.replace('Z', '+00:00'))
+
+
 def post2json(post: Post) -> MfObj:
     (fm, content_text) = post
     props = {}
     for k, v in fm.get("extra", {}).items():
-        props[k.replace("_", "-")] = v
+        props[k.translate(UNDERSCORE_TO_DASH)] = v
     if "title" in fm:
         props["name"] = [fm["title"]]
     if "description" in fm:
         props["summary"] = [fm["description"]]
     if "date" in fm:
-        if not isinstance(fm["date"], datetime):
-            fm["date"] = datetime.fromisoformat(fm["date"].replace('Z', '+00:00'))
-        props["published"] = [fm["date"].isoformat(timespec='seconds')]
+        props["published"] = [as_datetime(fm["date"]).isoformat(timespec='seconds')]
     if "updated" in fm:
-        if not isinstance(fm["updated"], datetime):
-            fm["updated"] = datetime.fromisoformat(fm["updated"].replace('Z', '+00:00'))
-        props["updated"] = [fm["updated"].isoformat(timespec='seconds')]
+        props["updated"] = [as_datetime(fm["updated"]).isoformat(timespec='seconds')]
     if "taxonomies" in fm and "tag" in fm["taxonomies"]:
         props["category"] = fm["taxonomies"]["tag"]
     if len(content_text.strip()) > 0:
@@ -629,7 +893,7 @@ def json2post_inner(post: Post, props: MfProps, add_mode: bool) -> Post:
         else:
             if "extra" not in fm:
                 fm["extra"] = {}
-            k = k.replace("-", "_")
+            k = k.translate(DASH_TO_UNDERSCORE)
             if add_mode and k in fm["extra"]:
                 fm["extra"][k] += v
             else:
@@ -661,7 +925,7 @@ async def micropub_create(request: Request, data: dict) -> Response:
     slug = data.get("mp-slug")
     (fm, content_text) = json2post(check_json(data))
     if not "date" in fm:
-        fm["date"] = datetime.now(timezone.utc).replace(microsecond=0)
+        fm["date"] = request_time(request).replace(microsecond=0)
     if "bearer_data" in request.scope and "client_id" in request.scope["bearer_data"]:
         if not "extra" in fm:
             fm["extra"] = {}
@@ -680,8 +944,11 @@ async def micropub_create(request: Request, data: dict) -> Response:
         slug = fm["date"].strftime("%Y-%m-%d-%H-%M-%S")
         fm["slug"] = slug  # store explicitly to prevent Zola from eating the date
     path = category + "/" + slug
-    async with AsyncClient() as h:
-        await put_post(h, os.path.join(path_prefix, path + ".md"), (fm, content_text))
+    await put_post(
+        get_http(),
+        os.path.join(path_prefix, path + ".md"),
+        (fm, content_text),
+    )
     return Response(
         None,
         headers={"Location": "https://{}/{}".format(request.headers["host"], path)},
@@ -709,7 +976,7 @@ def delete_props(post: Post, props: Iterable[str]) -> Post:
         else:
             if "extra" not in fm:
                 continue
-            fm["extra"].pop(k.replace("-", "_"), None)
+            fm["extra"].pop(k.translate(DASH_TO_UNDERSCORE), None)
     return (fm, content_text)
 
 
@@ -737,7 +1004,7 @@ def delete_vals(post: Post, props: dict) -> Post:
             if len(fm["taxonomies"]) == 0:
                 fm.pop("taxonomies", None)
         else:
-            k = k.replace("-", "_")
+            k = k.translate(DASH_TO_UNDERSCORE)
             if "extra" not in fm or k not in fm["extra"]:
                 continue
             fm["extra"][k] = [x for x in fm["extra"][k] if not x in v]
@@ -756,18 +1023,18 @@ async def micropub_update(request: Request, data: dict) -> Response:
             },
         )
     path = url2path(request, data["url"])
-    async with AsyncClient() as h:
-        (post, sha) = await get_post(h, path)
-        if "replace" in data:
-            post = json2post_inner(post, data["replace"], False)
-        if "add" in data:
-            post = json2post_inner(post, data["add"], True)
-        if "delete" in data and isinstance(data["delete"], list):
-            post = delete_props(post, data["delete"])
-        if "delete" in data and isinstance(data["delete"], dict):
-            post = delete_vals(post, data["delete"])
-        post[0]["updated"] = datetime.now(timezone.utc).replace(microsecond=0)
-        await put_post(h, path, post, post_sha=sha)
+    h = get_http()
+    (post, sha) = await get_post(h, path)
+    if "replace" in data:
+        post = json2post_inner(post, data["replace"], False)
+    if "add" in data:
+        post = json2post_inner(post, data["add"], True)
+    if "delete" in data and isinstance(data["delete"], list):
+        post = delete_props(post, data["delete"])
+    if "delete" in data and isinstance(data["delete"], dict):
+        post = delete_vals(post, data["delete"])
+    post[0]["updated"] = request_time(request).replace(microsecond=0)
+    await put_post(h, path, post, post_sha=sha)
     return Response(
         None,
         status_code=204,
@@ -784,93 +1051,114 @@ async def micropub_delete(request: Request, data: dict) -> Response:
             },
         )
     path = url2path(request, data["url"])
-    async with AsyncClient() as h:
-        (_, sha) = await get_post(h, path)
-        await delete_post(h, path, sha)
+    h = get_http()
+    await delete_post(h, path, await get_post_sha(h, path))
     return Response(
         None,
         status_code=204,
     )
 
 
-class Micropub(HTTPEndpoint):
-    @requires("auth")
-    async def get(self, request: Request) -> Response:
-        q = request.query_params.get("q")
-        if q == "config":
-            return JSONResponse(
-                {
-                    "media-endpoint": "https://{}/.sellout/media".format(
-                        request.headers["host"]
-                    )
-                }
-            )
-        if q == "syndicate-to":
-            return JSONResponse({"syndicate-to": []})
-        if q == "source":
-            url = request.query_params.get("url")
-            async with AsyncClient() as h:
-                (post, _) = await get_post(h, url2path(request, url))
-                return JSONResponse(post2json(post).dict())
-        return JSONResponse(
-            {"error": "invalid_request", "error_description": "Unsupported ?q value"},
-            status_code=400,
-        )
+# rendered once, scanners and confused clients hit these a lot
+UNSUPPORTED_Q_BODY = ORJSONResponse(
+    {"error": "invalid_request", "error_description": "Unsupported ?q value"}
+).body
+UNSUPPORTED_ACTION_BODY = ORJSONResponse(
+    {"error": "invalid_request", "error_description": "Unsupported action"}
+).body
 
-    # Cannot use @requires because the token can be in the form >_<
-    async def post(self, request: Request) -> Response:
-        content_type, options = parse_options_header(
-            request.headers.get("content-type")
+MICROPUB_ACTIONS = {
+    "create": micropub_create,
+    "update": micropub_update,
+    "delete": micropub_delete,
+    # TODO: "undelete": find last revision with the file in history and restore
+}
+
+
+@requires("auth")
+async def micropub_get(request: Request) -> Response:
+    q = request.query_params.get("q")
+    if q == "config":
+        return ORJSONResponse(
+            {
+                "media-endpoint": "https://{}/.sellout/media".format(
+                    request.headers["host"]
+                )
+            }
         )
-        if content_type == b"application/json":
-            data = await request.json()
-            action = data.get("action", "create")
-            if not has_required_scope(request, [action]):
-                raise AuthenticationError(403, {"error": "insufficient_scope"})
-            if action == "create":
-                return await micropub_create(request, data)
-            if action == "update":
-                return await micropub_update(request, data)
-            if action == "delete":
-                return await micropub_delete(request, data)
-            # if action == "undelete":
-            # TODO: find last revision with the file in history and restore
-            return JSONResponse(
-                {"error": "invalid_request", "error_description": "Unsupported action"},
+    if q == "syndicate-to":
+        return ORJSONResponse({"syndicate-to": []})
+    if q == "source":
+        url = request.query_params.get("url")
+        (post, _) = await get_post(get_http(), url2path(request, url))
+        return ORJSONResponse(post2json(post).dict())
+    return Response(
+        UNSUPPORTED_Q_BODY, status_code=400, media_type=ORJSONResponse.media_type
+    )
+
+
+# Cannot use @requires because the token can be in the form >_<
+async def micropub_post(request: Request) -> Response:
+    # only the media type matters here, no need for a full options header parse
+    content_type = request.headers.get("content-type", "").split(";", 1)[0]
+    if content_type.strip().lower() == "application/json":
+        try:
+            data = orjson.loads(await request.body())
+        except orjson.JSONDecodeError:
+            data = None
+        if not isinstance(data, dict):
+            raise DataError(
+                400,
+                {
+                    "error": "invalid_request",
+                    "error_description": "The request body must be a JSON object",
+                },
+            )
+        action = data.get("action", "create")
+        handler = MICROPUB_ACTIONS.get(action) if isinstance(action, str) else None
+        if handler is None:
+            return Response(
+                UNSUPPORTED_ACTION_BODY,
                 status_code=400,
+                media_type=ORJSONResponse.media_type,
             )
-        else:
-            form = await request.form()
-            if "access_token" in form and not "auth" in request.scope:
-                (
-                    request.scope["auth"],
-                    request.scope["user"],
-                ) = await authenticate_bearer(request, form["access_token"])
-            if not has_required_scope(request, ["create"]):
-                raise AuthenticationError(403, {"error": "insufficient_scope"})
-            h = "unknown"
-            props = {}
-            data = {}
-            for k, v in form.multi_items():
-                if isinstance(v, UploadFile):
-                    v = await upload_file(v)
-                if k == "h":
-                    data["type"] = ["h-" + v]
-                elif k == "access_token":
-                    pass
-                elif k.startswith("mp-"):
-                    data[k] = v
-                elif k.endswith("[]"):
-                    k = k[:-2]
-                    if k not in props:
-                        props[k] = [v]
-                    else:
-                        props[k].append(v)
-                else:
-                    props[k] = [v]
-            data["properties"] = props
-            return await micropub_create(request, data)
-        pass
+        if not has_required_scope(request, [action]):
+            raise AuthenticationError(403, {"error": "insufficient_scope"})
+        return await handler(request, data)
+    else:
+        form = await request.form()
+        if "access_token" in form and not "auth" in request.scope:
+            (
+                request.scope["auth"],
+                request.scope["user"],
+            ) = await authenticate_bearer(request, form["access_token"])
+        if not has_required_scope(request, ["create"]):
+            raise AuthenticationError(403, {"error": "insufficient_scope"})
+        h = "unknown"
+        props = defaultdict(list)
+        data = {}
+        items = form.multi_items()
+        urls = iter(
+            await upload_files(
+                get_http(),
+                [v for _, v in items if isinstance(v, UploadFile)],
+            )
+        )
+        for k, v in items:
+            if isinstance(v, UploadFile):
+                v = next(urls)
+            if k == "h":
+                data["type"] = ["h-" + v]
+            elif k == "access_token":
+                pass
+            elif k.startswith("mp-"):
+                data[k] = v
+            else:
+                # "photo" and "photo[]" both add to the same list
+                props[k[:-2] if k.endswith("[]") else k].append(v)
+        data["properties"] = dict(props)
+        return await micropub_create(request, data)
+    pass
 
 
 async def micropub_media(request: Request) -> Response:
@@ -892,39 +1180,56 @@ async def micropub_media(request: Request) -> Response:
         )
     return Response(
         None,
-        headers={"Location": await upload_file(form["file"])},
+        headers={"Location": await upload_file(get_http(), form["file"])},
         status_code=201,
     )
 
 
 def on_auth_error(conn: HTTPConnection, exc: Exception) -> Response:
     (status, obj) = exc.args
-    return JSONResponse(obj, status_code=status)
+    return ORJSONResponse(obj, status_code=status)
 
 
 async def on_exception(request: Request, exc: Exception) -> Response:
     (status, obj) = exc.args
-    return JSONResponse(obj, status_code=status)
+    return ORJSONResponse(obj, status_code=status)
+
 
+async def lifespan(app: Starlette) -> typing.AsyncGenerator:
+    yield
+    # only reached under a long-running server, Mangum is told to skip the lifespan
+    if http_client is not None:
+        await http_client.aclose()
+
+
+# the Mount is still needed for url_for, StaticMiddleware serves the actual requests
+static_files = StaticFiles(directory="static")
 
 app = Starlette(
     debug=True,
     routes=[
         Route("/", testpage),
         Route("/.sellout/", dashboard),
-        Route("/.sellout/pub", Micropub, name="micropub"),
+        Route("/.sellout/pub", micropub_get, name="micropub", methods=["GET"]),
+        Route("/.sellout/pub", micropub_post, methods=["POST"]),
         Route("/.sellout/media", micropub_media, name="media", methods=["POST"]),
         Route("/.sellout/login", Login, name="login"),
         Route("/.sellout/authz", Authorization, name="authz"),
         Route("/.sellout/token", Token, name="token"),
         Route("/.sellout/allow", allow, name="allow", methods=["POST"]),
         Route("/.sellout/logout", logout, name="logout", methods=["POST"]),
-        Mount("/.sellout/static", StaticFiles(directory="static"), name="static"),
+        Mount("/.sellout/static", static_files, name="static"),
     ],
     middleware=[
+        Middleware(
+            StaticMiddleware, prefix="/.sellout/static", static_app=static_files
+        ),
+        # inside the static shortcut, the woff2 fonts are compressed already
+        Middleware(GZipMiddleware, minimum_size=512, compresslevel=5),
         Middleware(WeirdnessMiddleware),
         Middleware(
-            SessionMiddleware,
+            ApiSessionMiddleware,
+            api_paths=["/.sellout/pub", "/.sellout/media"],
             secret_key=session_secret,
             session_cookie="__Host-wheeeee",
             same_site="Lax",
@@ -937,4 +1242,5 @@ app = Starlette(
         ),
     ],
     exception_handlers={AuthenticationError: on_exception, DataError: on_exception},
+    lifespan=lifespan,
 )